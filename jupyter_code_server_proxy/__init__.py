@@ -17,14 +17,36 @@ import os
 import re
 import tempfile
 import getpass
-import stat
 import logging
-import json
+import functools
+import shutil
 
-from typing import Any
-from typing import Dict
+from typing import Any, Dict
 
-import tornado
+# Environment variables are read once at import. The proxy process inherits
+# its environment from the spawner and it does not change during its lifetime
+_HOME = os.environ.get('HOME') or os.path.expanduser('~')
+_WORK = os.environ.get('WORK')
+_JOBSCRATCH = os.environ.get('JOBSCRATCH')
+_SERVER_NAME = os.environ.get('JUPYTERHUB_SERVER_NAME', 'jupyterlab')
+_ENV_ROOT = os.environ.get('CODE_SERVER_ENV_ROOT', 'usr/lib/code-server/')
+
+# code-server config file content. It is static so we write it as is
+_CONFIG_CONTENT = b'cert: false\n'
+
+# Port forwarding requests to code server, e.g. /code_server/1/proxy/8080
+_PORT_FORWARD_RE = re.compile(r'/code_server/[0-9]/proxy/')
+
+# Arguments managed by us that users cannot override
+_FORBIDDEN_ARGS = frozenset((
+    '--bind-addr', 'socket', 'socket-mode', '--install-extension',
+    '--extensions-dir', '--user-data-dir',
+))
+
+# Resources shipped with the package
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_ICON_PATH = os.path.join(_HERE, 'icons', 'code-server-logo.svg')
+_WRAPPER_SCRIPT = os.path.join(_HERE, 'data', 'code_server_wrapper.sh')
 
 
 def get_logger(name):
@@ -44,22 +66,43 @@ def get_logger(name):
     return logger
 
 
+def _open_for_writing(path, mode=0o666):
+    """Open file for writing and return its descriptor. Parent directories
+    are only created when they are missing"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    try:
+        return os.open(path, flags, mode)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return os.open(path, flags, mode)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_executable(executable):
+    """Return full path of executable. Only successful lookups are cached,
+    so a missing executable is looked up again on next spawn"""
+    path = shutil.which(executable)
+    if path is None:
+        raise FileNotFoundError(f'{executable} executable not found.')
+    return path
+
+
+# Set logging
+logger = get_logger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
 def setup_code_server() -> Dict[str, Any]:
     """ Setup commands and and return a dictionary compatible
         with jupyter-server-proxy.
     """
 
-    # Set logging
-    logger = get_logger(__name__)
-    logger.setLevel(logging.INFO)
-
     ##Conor Edit
     code_server_executable = 'code-server'
 
     # Get code server env root directory if set
-    code_server_env_root = os.environ.get('CODE_SERVER_ENV_ROOT', 'usr/lib/code-server/')
-    
-    
+    code_server_env_root = _ENV_ROOT
+
     # Update code_server_executable
     if code_server_env_root:
         code_server_executable = os.path.join(
@@ -67,26 +110,23 @@ def setup_code_server() -> Dict[str, Any]:
         )
 
     # Get home dir
-    home_dir = os.path.expanduser('~')
+    home_dir = _HOME
 
     # Get current user
     current_user = getpass.getuser()
 
     # code-server specific dirs
-    user_dir = os.path.join(os.environ.get(
-        'WORK', default=home_dir), 'code-server'
-    )
-    extensions_dir = os.path.join(os.environ.get(
-        'WORK', default=home_dir), 'code-server', 'extensions'
-    )
+    work_dir = _WORK or home_dir
+    user_dir = os.path.join(work_dir, 'code-server')
+    extensions_dir = os.path.join(user_dir, 'extensions')
 
     # By default we use JOBSCRATCH to place ephermal
     # scripts. If this is not available we need to have a smart fallback
     # option to take different users and different JupyterLab instances
     # into account.
     # Fallback is /tmp/$USER-{random-hash}
-    if os.environ.get('JOBSCRATCH'):
-        scratch_dir_perfix = os.environ.get('JOBSCRATCH')
+    if _JOBSCRATCH:
+        scratch_dir_perfix = _JOBSCRATCH
     else:
         scratch_dir_perfix = tempfile.mkdtemp(prefix=f'{current_user}-')
 
@@ -101,17 +141,27 @@ def setup_code_server() -> Dict[str, Any]:
     # Config file name
     # Each lab instance can have its own config file. We do not want to overwrite
     # existing lab config. So we prepend name of config with lab server name
-    code_server_config_file_name = os.environ.get(
-        'JUPYTERHUB_SERVER_NAME', default='jupyterlab'
-    )
     code_server_config_file = os.path.join(
-        home_dir, '.config', 'code-server',
-        f'{code_server_config_file_name}-config.yaml'
+        home_dir, '.config', 'code-server', f'{_SERVER_NAME}-config.yaml'
+    )
+
+    # Fixed part of code-server command arguments following the socket
+    # NOTE: seems like extensions-dir in config file is ignored. Maybe
+    # we should put an issue in the upstream project?
+    # We pass the extensions-dir argument as CLI
+    cmd_args_tail = (
+        'socket-mode', '700', '--auth', 'none',
+        '--config', code_server_config_file,
+        '--user-data-dir', user_dir, '--extensions-dir', extensions_dir,
+        '--disable-telemetry', '--disable-update-check'
     )
 
     def forbid_port_forwarding(response, request):
         """Forbid the port forwarding requests to code server"""
-        if re.search(f'(.*)/code_server/[0-9]/proxy/([0-9]*)', request.uri):
+        uri = request.uri
+        if '/proxy/' in uri and _PORT_FORWARD_RE.search(uri):
+            # Only needed on this rare path, so do not import at module load
+            import tornado.web
             response.code = 403
             raise tornado.web.HTTPError(
                 403, 'Port forwarding using code server is forbidden!!'
@@ -120,122 +170,41 @@ def setup_code_server() -> Dict[str, Any]:
     # Write code server config file to user's home
     def _write_config_file():
         """Write config file to config directory"""
-        # code-server config dir
-        code_server_config_dir = os.path.dirname(code_server_config_file)
-        # Ensure config dir exists
-        os.makedirs(code_server_config_dir, exist_ok=True)
-
-        # Config file attributes
-        config = {
-            'cert': False,
-        }
-
-        # Dump config file
-        with open(code_server_config_file, 'w') as f:
-            json.dump(config, f, indent=2)
-
-    def _get_icon_path():
-        """Get the icon path"""
-        return os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), 'icons',
-            'code-server-logo.svg'
-        )
+        # Dump config file. Keep it private to the user as code-server
+        # config can hold credentials
+        fd = _open_for_writing(code_server_config_file, 0o600)
+        try:
+            os.write(fd, _CONFIG_CONTENT)
+        finally:
+            os.close(fd)
 
     def _code_server_command(port, unix_socket, args):
         """Callable that we will pass to sever proxy to spin up
         code server"""
         # Check if code server executable is available
-        if not os.path.exists(code_server_executable):
-            raise FileNotFoundError(
-                f'{code_server_executable} executable not found.'
-            )
-
-        script_template = """#!/bin/bash
-exit_script() {{
-    get_child_pids $$
-    trap - SIGTERM # clear the trap
-    kill -INT $CPIDS # Sends SIGTERM to child/sub processes
-    exit 0
-}}
-
-function get_child_pids() {{
-    pids=`pgrep -P $1|xargs`
-    for pid in $pids;
-    do
-        CPIDS="$CPIDS $pid"
-        get_child_pids $pid
-    done
-}}
-
-trap exit_script SIGTERM
-
-CPIDS=''
-
-export PATH={code_server_env_bin}:$PATH
-
-# We need to send this process to background or else bash
-# will ignore TERM signal as it will wait for code-server to finish
-# before taking signal into account
-{code_server_executable} "$@" &
-wait
-""".format(
-    code_server_executable=code_server_executable,
-    code_server_env_bin=os.path.join(code_server_env_root, 'bin')
-)
-
-        scratch_dir = os.path.join(
-            scratch_dir_perfix,
-            'bin',
-            os.environ.get('JUPYTERHUB_SERVER_NAME', default='jupyterlab')
-        )
-
-        # Check if scratch dir exists and create one if it does not
-        if not os.path.exists(scratch_dir):
-            os.makedirs(scratch_dir, exist_ok=True)
-
-        # Path to code server wrapper
-        code_server_wrapper = os.path.join(
-            scratch_dir, 'code_server_wrapper.sh'
-        )
-
-        # Write wrapper script to directory
-        with open(code_server_wrapper, 'w') as f:
-            f.write(script_template)
-
-        # Make it executable
-        st = os.stat(code_server_wrapper)
-        os.chmod(code_server_wrapper, st.st_mode | stat.S_IEXEC)
-
-        # Make code-server command arguments
-        # NOTE: seems like extensions-dir in config file is ignored. Maybe
-        # we should put an issue in the upstream project?
-        # We pass the extensions-dir argument as CLI
-        cmd_args = [
-            code_server_wrapper, '--socket', str(unix_socket), 'socket-mode', '700',
-            '--auth', 'none', '--config', code_server_config_file,
-            '--user-data-dir', user_dir, '--extensions-dir', extensions_dir,
-            '--disable-telemetry', '--disable-update-check'
-        ]
-
-        # If arguments like host, port are found in config, delete them.
-        # We let Jupyter server proxy to take care of them
-        # Additionally we delete path_prefix as well.
-        for arg in [
-            '--bind-addr', 'socket', 'socket-mode',
-            '--install-extension',
-            '--extensions-dir', '--user-data-dir'
-            ]:
-            if arg in args:
-                idx = args.index(arg)
-                del args[idx:idx + 2]
+        _resolve_executable(code_server_executable)
+
+        # If arguments like host, port are found in config, drop them along
+        # with their values. We let Jupyter server proxy to take care of them.
+        # Build a new list so that caller's args are left untouched
+        user_args = []
+        args_iter = iter(args)
+        for arg in args_iter:
+            if arg in _FORBIDDEN_ARGS:
+                next(args_iter, None)
+                continue
+            user_args.append(arg)
 
         _write_config_file()
         logger.info(
             'Code server config file is written at %s', code_server_config_file
         )
 
-        # Append user provided arguments to cmd_args
-        cmd_args += args
+        # Make code-server command arguments and append user provided ones
+        cmd_args = [
+            _WRAPPER_SCRIPT, '--socket', str(unix_socket),
+            *cmd_args_tail, *user_args
+        ]
 
         logger.info(
             'Code server will be launched with arguments %s', cmd_args
@@ -248,13 +217,17 @@ wait
         'absolute_url': False,
         'timeout': 300,
         'new_browser_tab': True,
+        'environment': {
+            'CODE_SERVER_EXECUTABLE': code_server_executable,
+            'CODE_SERVER_ENV_BIN': os.path.join(code_server_env_root, 'bin'),
+        },
         'rewrite_response': forbid_port_forwarding,
         'unix_socket': unix_socket_path,
         'launcher_entry': {
             'enabled': True,
             'title': 'Code server',
             'num_instances': 1,
-            'icon_path': _get_icon_path(),
+            'icon_path': _ICON_PATH,
             'category': 'Applications',
         }
     }
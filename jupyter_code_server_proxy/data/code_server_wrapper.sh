@@ -0,0 +1,31 @@
+#!/bin/bash
+# Wrapper around code-server that forwards SIGTERM to all of its children.
+# CODE_SERVER_EXECUTABLE and CODE_SERVER_ENV_BIN are set by
+# jupyter_code_server_proxy when spawning this script
+exit_script() {
+    get_child_pids $$
+    trap - SIGTERM # clear the trap
+    kill -INT $CPIDS # Sends SIGTERM to child/sub processes
+    exit 0
+}
+
+function get_child_pids() {
+    pids=`pgrep -P $1|xargs`
+    for pid in $pids;
+    do
+        CPIDS="$CPIDS $pid"
+        get_child_pids $pid
+    done
+}
+
+trap exit_script SIGTERM
+
+CPIDS=''
+
+export PATH=$CODE_SERVER_ENV_BIN:$PATH
+
+# We need to send this process to background or else bash
+# will ignore TERM signal as it will wait for code-server to finish
+# before taking signal into account
+"$CODE_SERVER_EXECUTABLE" "$@" &
+wait
@@ -53,7 +53,9 @@ setup(
         ]
     },
     package_data={
-        'jupyter_code_server_proxy': ['icons/code-server-logo.png'],
+        'jupyter_code_server_proxy': [
+            'icons/code-server-logo.png', 'data/code_server_wrapper.sh'
+        ],
     },
     # install_requires=['jupyter-server-proxy==3.2.1'],
     include_package_data=True,